@@ -43,9 +43,6 @@ setup(
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
         'Programming Language :: Python :: 3'
     ],
-    install_requires=[
-        'pint',
-    ],
     entry_points={
         'console_scripts': [
             'pg_cloudconfig = pg_cloudconfig.pg_cloudconfig:main',
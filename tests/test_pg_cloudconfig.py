@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Unit tests for the tuning helpers of pg_cloudconfig"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from pg_cloudconfig import pg_cloudconfig
+
+
+class MemoryTest(unittest.TestCase):
+    def memory(self, total_byte):
+        pages = {'SC_PAGE_SIZE': 4096, 'SC_PHYS_PAGES': total_byte // 4096}
+        pg_cloudconfig.memory.cache_clear()
+        self.addCleanup(pg_cloudconfig.memory.cache_clear)
+        with mock.patch('os.sysconf', pages.get):
+            return pg_cloudconfig.memory()['total']
+
+    def test_kb_counted_as_1000_bytes(self):
+        self.assertEqual(self.memory(1024 * 1000 * 4096), 4096)
+
+    def test_memory_settings_of_nominal_sizes(self):
+        # MemTotal is usually about 98.5% of the nominal size
+        for gb, sb, mwm in ((16, 2048, 1024), (64, 8192, 4096)):
+            total = self.memory(int(gb * 1024**3 * 0.985))
+            self.assertEqual(pg_cloudconfig.shared_buffers(total), sb)
+            self.assertEqual(pg_cloudconfig.maintenance_work_mem(total), mwm)
+
+
+class RoundPowerOf2FloorTest(unittest.TestCase):
+    def test_exact_powers_of_2(self):
+        for mb in (256, 512, 1024, 2048, 4096, 8192, 16384):
+            self.assertEqual(pg_cloudconfig.round_power_of_2_floor(mb), mb)
+
+    def test_rounds_down(self):
+        self.assertEqual(pg_cloudconfig.round_power_of_2_floor(2047), 1024)
+        self.assertEqual(pg_cloudconfig.round_power_of_2_floor(2049), 2048)
+        self.assertEqual(pg_cloudconfig.round_power_of_2_floor(1), 1)
+
+    def test_below_1(self):
+        for number in (0, 0.5, -1):
+            self.assertEqual(pg_cloudconfig.round_power_of_2_floor(number), 0)
+
+    def test_all_powers_of_2(self):
+        # Large values are where float based log2 used to be off by one
+        for k in range(64):
+            self.assertEqual(pg_cloudconfig.round_power_of_2_floor(2**k), 2**k)
+            if k > 1:
+                self.assertEqual(
+                    pg_cloudconfig.round_power_of_2_floor(2**k - 1),
+                    2**(k - 1))
+
+
+class RoundPowerOf2CeilTest(unittest.TestCase):
+    def test_all_powers_of_2(self):
+        for k in range(64):
+            self.assertEqual(pg_cloudconfig.round_power_of_2_ceil(2**k), 2**k)
+            self.assertEqual(
+                pg_cloudconfig.round_power_of_2_ceil(2**k + 1), 2**(k + 1))
+
+    def test_up_to_1(self):
+        for number in (0, 1):
+            self.assertEqual(pg_cloudconfig.round_power_of_2_ceil(number), 1)
+
+
+class AutovacuumMaxWorkersTest(unittest.TestCase):
+    def assertWorkers(self, cpu_counts, workers):
+        for cc in cpu_counts:
+            self.assertEqual(
+                pg_cloudconfig.autovacuum_max_workers({'cpu_count': cc}),
+                workers)
+
+    def test_below_16_cpus(self):
+        self.assertWorkers((1, 2, 8, 15), 3)
+
+    def test_16_to_31_cpus(self):
+        self.assertWorkers((16, 24, 31), 4)
+
+    def test_from_32_cpus(self):
+        self.assertWorkers((32, 64, 128), 5)
+
+
+class SetConfLineTest(unittest.TestCase):
+    def set(self, lines, key='shared_buffers', value='1024MB'):
+        pg_cloudconfig.set_conf_line(lines, key, value)
+        return lines
+
+    def test_replace_active(self):
+        self.assertEqual(
+            self.set(["shared_buffers = 128MB\t\t# min 128kB\n"]),
+            ["shared_buffers = 1024MB\t\t# min 128kB\n"])
+
+    def test_active_before_commented(self):
+        self.assertEqual(
+            self.set(["#shared_buffers = 32MB\n", "shared_buffers = 128MB\n"]),
+            ["#shared_buffers = 32MB\n", "shared_buffers = 1024MB\n"])
+
+    def test_trailing_whitespace(self):
+        self.assertEqual(
+            self.set(["#shared_buffers = 32MB\n",
+                      "shared_buffers = 128MB \n"]),
+            ["#shared_buffers = 32MB\n", "shared_buffers = 1024MB\n"])
+
+    def test_crlf(self):
+        self.assertEqual(
+            self.set(["#shared_buffers = 32MB\r\n",
+                      "shared_buffers = 128MB # min 128kB\r\n"]),
+            ["#shared_buffers = 32MB\r\n",
+             "shared_buffers = 1024MB # min 128kB\n"])
+
+    def test_quoted_value(self):
+        self.assertEqual(
+            self.set(["search_path = 'it''s, public' # c\n"], 'search_path',
+                     "'public'"), ["search_path = 'public' # c\n"])
+
+    def test_uncomment(self):
+        self.assertEqual(
+            self.set(["# shared_buffers is set below\n",
+                      "#shared_buffers = 128MB  # min 128kB \n"]),
+            ["# shared_buffers is set below\n",
+             "shared_buffers = 1024MB  # min 128kB\n"])
+
+    def test_append(self):
+        self.assertEqual(
+            self.set(["#shared_buffers_x = 128MB\n"]),
+            ["#shared_buffers_x = 128MB\n", "shared_buffers = 1024MB\n"])
+
+    def test_key_case_insensitive(self):
+        self.assertEqual(
+            self.set(["Shared_Buffers = 128MB\n"]),
+            ["Shared_Buffers = 1024MB\n"])
+
+
+class LoadConfTest(unittest.TestCase):
+    def setUp(self):
+        pg_cloudconfig.load_conf.cache_clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fh:
+            fh.write(content)
+        return path
+
+    def test_settings(self):
+        conf = self.write("postgresql.conf", "# comment\n"
+                          "Max_Connections = 100\t# change requires restart\n"
+                          "#work_mem = 4MB\n"
+                          "search_path = 'it''s, public'\n"
+                          "port 5433\n"
+                          "max_connections = 200\n")
+        self.assertEqual(pg_cloudconfig.load_conf(conf), {
+            'max_connections': '200',
+            'search_path': "it's, public",
+            'port': '5433',
+        })
+
+    def test_includes(self):
+        conf = self.write("postgresql.conf", "max_connections = 100\n"
+                          "work_mem = 1MB\n"
+                          "include_dir = 'conf.d'\n"
+                          "include_if_exists = 'missing.conf'\n"
+                          "include 'sub/a.conf'\n"
+                          "work_mem = 8MB\n")
+        self.write("conf.d/01.conf", "max_connections = 300\n")
+        self.write("conf.d/02.conf", "max_connections = 400\n")
+        self.write("conf.d/03.conf.bak", "max_connections = 999\n")
+        self.write("sub/a.conf", "port = 5433\ninclude = 'b.conf'\n")
+        self.write("sub/b.conf", "port = 5434\n")
+        self.assertEqual(pg_cloudconfig.load_conf(conf), {
+            'max_connections': '400',
+            'work_mem': '8MB',
+            'port': '5434',
+        })
+
+    def test_missing_include(self):
+        conf = self.write("postgresql.conf", "include = 'missing.conf'\n")
+        self.assertRaises(FileNotFoundError, pg_cloudconfig.load_conf, conf)
+
+    def test_include_loop(self):
+        conf = self.write("postgresql.conf", "include = 'postgresql.conf'\n")
+        self.assertRaises(OSError, pg_cloudconfig.load_conf, conf)
+
+
+if __name__ == '__main__':
+    unittest.main()